@@ -0,0 +1,261 @@
+"""Data loading, cleaning and analysis helpers shared by the Streamlit page in anova_tool.py."""
+import streamlit as st
+import pandas as pd
+import numpy as np
+import altair as alt
+import copy
+import tempfile
+import weakref
+from io import BytesIO
+from pathlib import Path
+from uuid import uuid4
+
+
+# Downcast numeric columns where no value changes and store repetitive text as categories
+def shrink_dtypes(df):
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_bool_dtype(s):
+            continue
+        if pd.api.types.is_integer_dtype(s):
+            # Signed only; derive_column widens back to int64 before any arithmetic
+            df[col] = pd.to_numeric(s, downcast="integer")
+        elif pd.api.types.is_float_dtype(s):
+            # Only when every value survives the float32 round trip exactly
+            as_float32 = s.astype(np.float32)
+            if np.array_equal(as_float32.to_numpy(dtype=np.float64), s.to_numpy(dtype=np.float64), equal_nan=True):
+                df[col] = as_float32
+        elif (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)) and len(s) and s.nunique() / len(s) < 0.5:
+            df[col] = s.astype("category")
+    return df
+
+
+# Object columns holding several Python types (e.g. an Excel id column of 1, 'x2', 3) have no single
+# parquet type. Deliberately store them as text; blanks stay missing instead of becoming 'nan'
+def _text_if_mixed(df):
+    for col in df.columns:
+        s = df[col]
+        if pd.api.types.is_object_dtype(s) and pd.api.types.infer_dtype(s, skipna=True) in ("mixed", "mixed-integer"):
+            df[col] = s.where(s.isna(), s.astype(str))
+    return df
+
+
+# Per-process scratch directory for parquet files; removed when the server process exits
+_TMP_DIR = tempfile.TemporaryDirectory(prefix="anova_tool_")
+
+
+# A parquet file owned by one holder; the file is deleted as soon as the holder is dropped,
+# i.e. when a session replaces its working copy or the session itself goes away
+class WorkingFile:
+    def __init__(self, path):
+        self.path = path
+        weakref.finalize(self, Path(path).unlink, missing_ok=True)
+
+
+# Write a DataFrame to a new parquet file in the scratch dir; the session only keeps the path
+def save_parquet(df):
+    path = Path(_TMP_DIR.name) / f"{uuid4()}.parquet"
+    df.to_parquet(path, index=False, compression="zstd")
+    return str(path)
+
+
+# Parse the uploaded bytes and spill them to parquet; the page calls this once per new upload
+def load_upload(name, data):
+    if name.endswith(".csv"):
+        # pyarrow either rejects repeated header names or keeps them as-is depending on the
+        # pandas version; the C parser dedupes them to a, a.1, ... as the page always did
+        try:
+            df = pd.read_csv(BytesIO(data), engine="pyarrow")
+        except ValueError:
+            df = None
+        if df is None or df.columns.has_duplicates:
+            df = pd.read_csv(BytesIO(data))
+    elif name.endswith(".xlsx"):
+        df = pd.read_excel(BytesIO(data), engine="calamine")
+    return save_parquet(shrink_dtypes(_text_if_mixed(df)))
+
+
+# Lazy handle on the parquet file; nothing is read until columns are requested.
+# Working files are short-lived, so only the most recent handles are kept
+@st.cache_resource(max_entries=16)
+def open_dataset(path):
+    import pyarrow.dataset as ds
+
+    return ds.dataset(path, format="parquet")
+
+
+# Materialize only the requested columns of a parquet file. Each column is read once; a column
+# requested twice (e.g. merged with itself) is repeated in the frame, as df[[a, a]] would be
+def read_columns(path, columns, head=None):
+    columns = list(columns)
+    unique = list(dict.fromkeys(columns))
+    dataset = open_dataset(path)
+    table = dataset.to_table(columns=unique) if head is None else dataset.head(head, columns=unique)
+    df = table.to_pandas()
+    return df if len(unique) == len(columns) else df[columns]
+
+
+# Add or replace a column: write the data with it to a new parquet file and return that file's path.
+# A derived column can mix types (merging a text column with a numeric one), so the upload's rule applies
+def add_column(path, name, values):
+    df = read_columns(path, open_dataset(path).schema.names)
+    df[name] = values
+    return save_parquet(_text_if_mixed(df))
+
+
+# Selected columns as one contiguous numeric block, or None when pandas' NaN-skipping reductions are needed
+def _row_block(df):
+    values = np.ascontiguousarray(df.to_numpy())
+    if values.shape[1] == 0 or values.dtype.kind not in "iuf":
+        return None
+    if values.dtype.kind == "f":
+        if np.isnan(values).any():
+            return None
+        return values.astype(np.float64)
+    return values
+
+
+# Cleaning operations are pure functions of the selected columns, so repeat clicks reuse the result
+@st.cache_data(max_entries=32)
+def derive_column(df, operation):
+    if operation in ("Mean", "Sum"):
+        values = _row_block(df)
+        if values is None:
+            # Same float64 accumulation as the fast path; float32 storage must not leak into the result
+            df = df.astype({col: np.float64 for col in df.columns if pd.api.types.is_float_dtype(df[col])})
+            return df.mean(axis=1) if operation == "Mean" else df.sum(axis=1)
+        if operation == "Mean":
+            return pd.Series(values.mean(axis=1, dtype=np.float64), index=df.index)
+        return pd.Series(values.sum(axis=1), index=df.index)
+    elif operation == "8 - Variable":
+        values = df.iloc[:, 0].to_numpy()
+        if values.dtype.kind in "iu":
+            values = values.astype(np.int64)
+        elif values.dtype.kind == "f":
+            values = values.astype(np.float64)
+        return pd.Series(8 - values, index=df.index)
+    elif operation == "Merge Two Columns (Remove Blanks)":
+        first = df.iloc[:, 0].to_numpy()
+        second = df.iloc[:, 1].to_numpy()
+        return pd.Series(np.where(pd.isna(first), second, first), index=df.index)
+
+
+# Treatment-coded dummies for the observed levels, first level as reference (same as patsy's C())
+def _dummies(s):
+    codes, levels = pd.factorize(s, sort=True)
+    return (codes[:, None] == np.arange(1, len(levels))).astype(float)
+
+
+# Full and per-term reduced design matrices for DV ~ C(factor) + covariates
+def anova_designs(df, dependent_var, independent_var, covariates):
+    data = df[[dependent_var, independent_var, *covariates]].dropna()
+    y = data[dependent_var].to_numpy(dtype=float)
+
+    blocks = {f"C({independent_var})": _dummies(data[independent_var])}
+    for cov in covariates:
+        if pd.api.types.is_numeric_dtype(data[cov]):
+            blocks[cov] = data[[cov]].to_numpy(dtype=float)
+        else:
+            blocks[cov] = _dummies(data[cov])
+    # Centre and scale every non-intercept column. With the intercept in each model this leaves every
+    # RSS unchanged, but keeps X.T @ X well conditioned (e.g. a covariate near 1e6 with SD 0.01)
+    for term, block in blocks.items():
+        block = block - block.mean(axis=0)
+        scale = block.std(axis=0)
+        blocks[term] = block / np.where(scale > 0, scale, 1.0)
+
+    intercept = np.ones((len(y), 1))
+    X_full = np.hstack([intercept, *blocks.values()])
+    X_reduced_per_term = {
+        term: np.hstack([intercept, *(b for t, b in blocks.items() if t != term)])
+        for term in blocks
+    }
+    return y, X_full, X_reduced_per_term
+
+
+# Residual sum of squares and rank of the least-squares fit. The normal equations are solved by Cholesky;
+# rank-deficient designs (e.g. a covariate that rescales another) fall back to lstsq's minimum-norm solution
+def _rss(y, X):
+    from scipy.linalg import LinAlgError, cho_factor, cho_solve
+
+    try:
+        factor = cho_factor(X.T @ X)
+        pivots = np.abs(np.diag(factor[0]))
+        if pivots.min() <= pivots.max() * 1e-7:
+            raise LinAlgError("design matrix is rank deficient")
+        beta = cho_solve(factor, X.T @ y)
+        rank = X.shape[1]
+    except LinAlgError:
+        beta, _, rank, _ = np.linalg.lstsq(X, y, rcond=None)
+    resid = y - X @ beta
+    return resid @ resid, rank
+
+
+# Type-II ANOVA table (same layout as sm.stats.anova_lm(typ=2)) from nested-model RSS differences
+def fast_anova_type2(y, X_full, X_reduced_per_term):
+    from scipy.stats import f as f_dist
+
+    rss_full, rank_full = _rss(y, X_full)
+    df_resid = len(y) - rank_full
+
+    rows = {}
+    for term, X_reduced in X_reduced_per_term.items():
+        rss_reduced, rank_reduced = _rss(y, X_reduced)
+        rows[term] = [max(rss_reduced - rss_full, 0.0), float(rank_full - rank_reduced)]
+    anova_table = pd.DataFrame.from_dict(rows, orient="index", columns=["sum_sq", "df"])
+    # A term fully aliased by the others adds no columns of rank: df 0, no F test
+    anova_table["F"] = (anova_table["sum_sq"] / anova_table["df"].where(anova_table["df"] > 0)) / (rss_full / df_resid)
+    anova_table["PR(>F)"] = f_dist.sf(anova_table["F"], anova_table["df"], df_resid)
+    anova_table.loc["Residual"] = [rss_full, float(df_resid), np.nan, np.nan]
+    return anova_table
+
+
+# Per-group size, mean and sample standard deviation from bincount sums over the category codes
+def group_mean_std(codes, y, k):
+    valid = (codes >= 0) & ~np.isnan(y)
+    codes, y = codes[valid], y[valid]
+    n = np.bincount(codes, minlength=k)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = np.bincount(codes, weights=y, minlength=k) / n
+        ss = np.bincount(codes, weights=(y - mean[codes]) ** 2, minlength=k)
+        std = np.sqrt(ss / (n - 1))
+    return n, mean, std
+
+
+# statsmodels OLS model for a formula; the patsy parse and design matrices are built once per (formula, data).
+# Only the last few designs are kept so cached frames do not pile up across sessions
+@st.cache_resource(max_entries=4)
+def _ols_model(formula, df):
+    from statsmodels.formula.api import ols
+
+    return ols(formula, data=df)
+
+
+# Per-call copy of the cached model: fit() stores its work (exog_Q, pinv_wexog, ...) on the
+# model, so each caller gets its own object sharing the read-only design arrays
+def build_design(formula, df):
+    return copy.copy(_ols_model(formula, df))
+
+
+# Group-means bar chart with SD error bars and mean labels, rendered client-side by Vega-Lite
+@st.cache_resource(max_entries=8)
+def bar_chart(x, mean, std, dependent_var, independent_var):
+    mean = np.asarray(mean, dtype=float)
+    std = np.asarray(std, dtype=float)
+    upper = mean + std
+
+    # Annotations for every bar at once: formatted means placed just above the error bar
+    data = pd.DataFrame({
+        'level': [str(v) for v in x],
+        'mean': mean,
+        'lower': mean - std,
+        'upper': upper,
+        'label': np.char.mod('%.2f', mean),
+        'label_y': np.fmax(mean, upper),
+    })
+
+    base = alt.Chart(data).encode(x=alt.X('level:N', title=independent_var, sort=None))
+    bars = base.mark_bar(color='skyblue').encode(y=alt.Y('mean:Q', title=dependent_var))
+    error_bars = base.mark_rule().encode(y='lower:Q', y2='upper:Q')
+    labels = base.mark_text(baseline='bottom', dy=-2).encode(y='label_y:Q', text='label:N')
+    return (bars + error_bars + labels).properties(title=f"Mean {dependent_var} by {independent_var}")
@@ -1,12 +1,23 @@
 import streamlit as st
+import hashlib
 import pandas as pd
-import statsmodels.api as sm
-from statsmodels.formula.api import ols
-from scipy.stats import chi2_contingency
-import matplotlib.pyplot as plt
-import seaborn as sns
+import numpy as np
 from io import BytesIO
 
+from anova_core import (
+    WorkingFile,
+    load_upload,
+    open_dataset,
+    read_columns,
+    add_column,
+    derive_column,
+    anova_designs,
+    fast_anova_type2,
+    group_mean_std,
+    build_design,
+    bar_chart,
+)
+
 # Title and Description
 st.title("Enhanced Statistical Analysis Tool")
 st.markdown("""
@@ -23,18 +34,19 @@ uploaded_file = st.file_uploader("Upload your dataset (CSV or Excel)", type=["cs
 
 if uploaded_file:
     try:
-        # Load the dataset
-        if uploaded_file.name.endswith(".csv"):
-            df = pd.read_csv(uploaded_file)
-        elif uploaded_file.name.endswith(".xlsx"):
-            df = pd.read_excel(uploaded_file)
+        # Load the dataset once per upload; session state keeps only the session's parquet files
+        data = uploaded_file.getvalue()
+        digest = hashlib.sha256(data).hexdigest()
+        if st.session_state.get("source") != digest:
+            st.session_state["source"] = digest
+            st.session_state["source_file"] = WorkingFile(load_upload(uploaded_file.name, data))
+            st.session_state["df_file"] = st.session_state["source_file"]
 
         st.write("Preview of Uploaded Data:")
-        st.write(df.head())
+        st.write(open_dataset(st.session_state["source_file"].path).head(5).to_pandas())
 
-        # Initialize session state for dynamic variables
-        if "df" not in st.session_state:
-            st.session_state["df"] = df
+        path = st.session_state["df_file"].path
+        columns = open_dataset(path).schema.names
 
         # Data Cleaning Section
         st.markdown("### Data Cleaning")
@@ -43,38 +55,43 @@ if uploaded_file:
         operation = st.selectbox("Select Cleaning Operation", ["None", "Mean", "Sum", "8 - Variable", "Merge Two Columns (Remove Blanks)"])
         if operation != "None":
             if operation == "Mean":
-                columns_to_average = st.multiselect("Select Columns to Average", options=st.session_state["df"].columns)
+                columns_to_average = st.multiselect("Select Columns to Average", options=columns)
                 new_variable_name = st.text_input("New Variable Name", "mean_variable")
                 if st.button("Create Mean Variable"):
-                    st.session_state["df"][new_variable_name] = st.session_state["df"][columns_to_average].mean(axis=1)
+                    values = derive_column(read_columns(path, columns_to_average), operation)
+                    st.session_state["df_file"] = WorkingFile(add_column(path, new_variable_name, values))
                     st.success(f"New variable '{new_variable_name}' created.")
             
             elif operation == "Sum":
-                columns_to_sum = st.multiselect("Select Columns to Sum", options=st.session_state["df"].columns)
+                columns_to_sum = st.multiselect("Select Columns to Sum", options=columns)
                 new_variable_name = st.text_input("New Variable Name", "sum_variable")
                 if st.button("Create Sum Variable"):
-                    st.session_state["df"][new_variable_name] = st.session_state["df"][columns_to_sum].sum(axis=1)
+                    values = derive_column(read_columns(path, columns_to_sum), operation)
+                    st.session_state["df_file"] = WorkingFile(add_column(path, new_variable_name, values))
                     st.success(f"New variable '{new_variable_name}' created.")
 
             elif operation == "8 - Variable":
-                column_to_subtract = st.selectbox("Select Column to Subtract from 8", options=st.session_state["df"].columns)
+                column_to_subtract = st.selectbox("Select Column to Subtract from 8", options=columns)
                 new_variable_name = st.text_input("New Variable Name", "subtract_variable")
                 if st.button("Create Subtracted Variable"):
-                    st.session_state["df"][new_variable_name] = 8 - st.session_state["df"][column_to_subtract]
+                    values = derive_column(read_columns(path, [column_to_subtract]), operation)
+                    st.session_state["df_file"] = WorkingFile(add_column(path, new_variable_name, values))
                     st.success(f"New variable '{new_variable_name}' created.")
 
             elif operation == "Merge Two Columns (Remove Blanks)":
-                col1 = st.selectbox("Select First Column", options=st.session_state["df"].columns, key="merge_col1")
-                col2 = st.selectbox("Select Second Column", options=st.session_state["df"].columns, key="merge_col2")
+                col1 = st.selectbox("Select First Column", options=columns, key="merge_col1")
+                col2 = st.selectbox("Select Second Column", options=columns, key="merge_col2")
                 new_variable_name = st.text_input("New Variable Name", "merged_variable")
                 if st.button("Merge Columns"):
-                    st.session_state["df"][new_variable_name] = st.session_state["df"][col1].combine_first(st.session_state["df"][col2])
+                    values = derive_column(read_columns(path, [col1, col2]), operation)
+                    st.session_state["df_file"] = WorkingFile(add_column(path, new_variable_name, values))
                     st.success(f"New variable '{new_variable_name}' created.")
 
         # Updated DataFrame
-        df = st.session_state["df"]
+        path = st.session_state["df_file"].path
+        columns = open_dataset(path).schema.names
         st.write("Updated Data:")
-        st.write(df.head())
+        st.write(read_columns(path, columns, head=5))
 
         # Analysis Selection
         analysis_type = st.selectbox("Select Analysis Type", ["ANOVA", "Chi-Square Test", "Model 4 (Mediation)", "Model 7 (Moderated Mediation)", "Model 14 (Moderated Moderation)"])
@@ -83,34 +100,60 @@ if uploaded_file:
             # ANOVA Section
             st.markdown("### ANOVA Analysis")
 
-            dependent_var = st.selectbox("Select Dependent Variable (DV)", options=df.columns)
-            independent_var = st.selectbox("Select Independent Variable (Factor)", options=[col for col in df.columns if col != dependent_var])
+            dependent_var = st.selectbox("Select Dependent Variable (DV)", options=columns)
+            independent_var = st.selectbox("Select Independent Variable (Factor)", options=[col for col in columns if col != dependent_var])
 
             # Add covariates
-            covariates = st.multiselect("Select Covariates (Optional)", options=[col for col in df.columns if col not in [dependent_var, independent_var]])
+            covariates = st.multiselect("Select Covariates (Optional)", options=[col for col in columns if col not in [dependent_var, independent_var]])
+
+            df = read_columns(path, [dependent_var, independent_var, *covariates])
 
             # Relabel categorical variable levels
             if df[independent_var].nunique() <= 2:
                 st.markdown("### Label Categorical Levels")
-                unique_levels = df[independent_var].unique()
+                factor = df[independent_var].astype('category')
                 label_mapping = {}
-                for level in unique_levels:
+                for level in factor.cat.categories:
                     label_mapping[level] = st.text_input(f"Rename Level '{level}'", value=str(level))
-                df[independent_var] = df[independent_var].replace(label_mapping)
+                # Relabel the levels rather than every row; map() merges levels given the same label
+                if len(set(label_mapping.values())) == len(label_mapping):
+                    df[independent_var] = factor.cat.rename_categories(label_mapping)
+                else:
+                    df[independent_var] = factor.map(label_mapping)
+                # Persist changed labels so they carry into the downloaded data
+                if any(str(level) != label for level, label in label_mapping.items()):
+                    st.session_state["df_file"] = WorkingFile(add_column(path, independent_var, df[independent_var]))
+                    path = st.session_state["df_file"].path
+
+            # Factorize the factor once; the group summaries and C() reuse the category codes
+            df = df.assign(**{independent_var: df[independent_var].astype('category')})
+
+            use_statsmodels = st.checkbox("Fit with statsmodels (slower)", value=False)
 
             if st.button("Run ANOVA"):
                 try:
-                    # ANOVA formula with covariates
-                    covariate_formula = " + ".join(covariates)
-                    formula = f"{dependent_var} ~ C({independent_var})"
-                    if covariate_formula:
-                        formula += f" + {covariate_formula}"
+                    if use_statsmodels:
+                        import statsmodels.api as sm
 
-                    model = ols(formula, data=df).fit()
-                    anova_table = sm.stats.anova_lm(model, typ=2)
+                        # ANOVA formula with covariates
+                        covariate_formula = " + ".join(covariates)
+                        formula = f"{dependent_var} ~ C({independent_var})"
+                        if covariate_formula:
+                            formula += f" + {covariate_formula}"
+
+                        model = build_design(formula, df).fit(method='qr')
+                        anova_table = sm.stats.anova_lm(model, typ=2)
+                    else:
+                        y, X_full, X_reduced_per_term = anova_designs(df, dependent_var, independent_var, covariates)
+                        anova_table = fast_anova_type2(y, X_full, X_reduced_per_term)
 
                     # Calculate group statistics
-                    group_stats = df.groupby(independent_var)[dependent_var].agg(['mean', 'std']).reset_index()
+                    factor = df[independent_var].cat
+                    n, mean, std = group_mean_std(factor.codes.to_numpy(), df[dependent_var].to_numpy(dtype=float), len(factor.categories))
+                    observed = n > 0
+                    levels = np.asarray(factor.categories[observed])
+                    mean, std = mean[observed], std[observed]
+                    group_stats = pd.DataFrame({independent_var: levels, 'mean': mean, 'std': std})
 
                     # Display ANOVA table and group stats
                     st.markdown("### ANOVA Results")
@@ -122,19 +165,14 @@ if uploaded_file:
 
                     # Bar Chart
                     st.markdown("### Visualization: Group Means")
-                    fig, ax = plt.subplots()
-                    bars = group_stats.plot(kind='bar', x=independent_var, y='mean', yerr='std', ax=ax, legend=False, color='skyblue', capsize=4)
-                    ax.set_title(f"Mean {dependent_var} by {independent_var}")
-                    ax.set_xlabel(independent_var)
-                    ax.set_ylabel(dependent_var)
-
-                    # Annotate means on the bar chart
-                    for bar in ax.patches:
-                        ax.annotate(f"{bar.get_height():.2f}",
-                                    (bar.get_x() + bar.get_width() / 2, bar.get_height()),
-                                    ha='center', va='bottom')
-
-                    st.pyplot(fig)
+                    chart = bar_chart(
+                        tuple(group_stats[independent_var]),
+                        tuple(group_stats['mean']),
+                        tuple(group_stats['std']),
+                        dependent_var,
+                        independent_var,
+                    )
+                    st.altair_chart(chart, width="stretch")
 
                     # **Download Options**
                     st.markdown("### Download Results")
@@ -150,7 +188,7 @@ if uploaded_file:
 
                     # Download Updated DataFrame
                     output = BytesIO()
-                    df.to_excel(output, index=False, engine='openpyxl')
+                    read_columns(path, columns).to_excel(output, index=False, engine='openpyxl')
                     output.seek(0)
                     st.download_button(
                         label="Download Updated Data (Excel)",
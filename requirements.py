@@ -1,6 +0,0 @@
-streamlit==1.25.0
-pandas
-matplotlib
-seaborn
-statsmodels
-scipy